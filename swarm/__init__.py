@@ -1,23 +1,60 @@
 import asyncio
+import time
+from array import array
+
 from swarm.swarm import *
 
+from .backlog import OverflowPolicy
+from .rules import RuleEngine, when
 from .serialhandler import SerialHandler
+from .shm import SharedSnapshotReader, SharedSnapshotWriter
+from .snapshot import Snapshot
 
 
 class FtSwarm(FtSwarmBase):
-    def __init__(self, port: str, serial_handler_class=SerialHandler):
+    def __init__(self, port: str, serial_handler_class=SerialHandler, backlog_size: int = 256,
+                 overflow_policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST, shared_table: str | None = None,
+                 shared_table_capacity: int = 64, reconnect: bool = True, min_reply_timeout: float = 1.0):
+        """
+        :param shared_table: path of a memory mapped file to mirror all subscribed values to, other processes can
+                             read it with SharedSnapshotReader. Keys are named like in snapshot(), e.g. "joy.lr",
+                             "i2c.reg3". A joystick takes two slots, an I2C port eight
+        :param serial_handler_class: called as serial_handler_class(port, logger). backlog_size, overflow_policy,
+                                     reconnect and min_reply_timeout are passed to its configure() method if it has one
+        :param reconnect: reopen the port when the link drops and set up all objects and rules again
+        :param min_reply_timeout: seconds the default reply timeout never drops below, lower it only for links
+                                  known to answer in time
+        """
         super().__init__()
         self.logger = logging.getLogger("swarm")
         self.serial_handler = serial_handler_class(port, self.logger)
+        if hasattr(self.serial_handler, "configure"):
+            self.serial_handler.configure(backlog_size=backlog_size, overflow_policy=overflow_policy,
+                                          reconnect=reconnect, min_reply_timeout=min_reply_timeout)
+        self.serial_handler.on_reconnect = self._resubscribe
         self.serial_handler.try_reboot()
         self.objects = {}
+        self.rules = RuleEngine()
+        self.shared_table = SharedSnapshotWriter(shared_table, shared_table_capacity) if shared_table else None
+        # Last value written to each slot of the shared table, unchanged fields keep the time they were last set
+        self._published: dict[str, int] = {}
+
+        self._input_task = asyncio.create_task(self.input_loop())
 
-        asyncio.create_task(self.input_loop())
+    async def send(self, port_name: str, command: str, *args: str | int | float,
+                   timeout: float | None = None) -> int | str | None:
+        """
+        Send a command to the swarm and return its reply
 
-    async def send(self, port_name: str, command: str, *args: str | int | float) -> int | str | None:
+        :param timeout: seconds until TimeoutError is raised, including the wait for other commands. Without it
+                        only the reply is timed, based on the measured link latency
+        """
         cmd = self._build_command(port_name, command, args)
-        result = await self.serial_handler.send_and_wait(cmd, command != "subscribe")
+        result = await self.serial_handler.send_and_wait(cmd, command != "subscribe", timeout)
+        return self._parse_result(result)
 
+    @staticmethod
+    def _parse_result(result: str | None) -> int | str | None:
         if result is None:
             return None
 
@@ -26,28 +63,103 @@ class FtSwarm(FtSwarmBase):
         except ValueError:
             return result
 
-    async def queue_use(self):
+    async def snapshot(self, refresh: bool = False) -> Snapshot:
+        """
+        Capture all cached IO values at once
+
+        :param refresh: fetch values no subscription keeps up to date (pixels, servos) first, in a single
+                        pipelined exchange
+        """
+        if refresh:
+            queries = [(port, field, self._build_command(port._port_name, command, args))
+                       for port in self.objects.values()
+                       for field, command, args in port.get_refresh_queries()]
+            replies = await self.serial_handler.send_batch([cmd for _, _, cmd in queries])
+            for (port, field, _), reply in zip(queries, replies):
+                value = self._parse_result(reply)
+                if isinstance(value, int):
+                    port.store_cached_value(field, value)
+
+        # No await from here on, so no update can slip in between two values
+        index = {}
+        values = array("q")
+        for port_name, port in self.objects.items():
+            for field, value in port.get_cached_values().items():
+                if isinstance(value, int):
+                    index[Snapshot.key(port_name, field)] = len(values)
+                    values.append(value)
+
+        return Snapshot(time.time(), index, values)
+
+    def close(self) -> None:
+        self._input_task.cancel()
+        self.serial_handler.close()
+        if self.shared_table is not None:
+            self.shared_table.close()
+
+    def stats(self) -> dict[str, dict]:
+        return {
+            "backlog": self.serial_handler.backlog_stats(),
+            "rtt": self.serial_handler.rtt_stats(),
+            "link": self.serial_handler.link_stats(),
+        }
+
+    async def _resubscribe(self, send_batch) -> None:
+        # Everything goes out in one burst, the swarm answers in order
+        queries = []
+        for port in self.objects.values():
+            for field, command, args in await port.get_setup_queries():
+                queries.append((port, field, command, self._build_command(port._port_name, command, args)))
+        for rule in self.rules.compiled_rules.values():
+            command, args = rule.trigger_command()
+            queries.append((rule.source, None, command, self._build_command(rule.source._port_name, command, args)))
+
+        replies = await send_batch([cmd for _, _, _, cmd in queries],
+                                   [command != "subscribe" for _, _, command, _ in queries])
+        for (port, field, _, _), reply in zip(queries, replies):
+            if field is not None:
+                port.store_cached_value(field, self._parse_result(reply))
+
+        for port in self.objects.values():
+            self._publish(port)
+
+    async def queue_use(self) -> bool:
+        """
+        Handle one message from the swarm
+        :return: False if there was nothing to handle
+        """
         message = await self.serial_handler.get_message()  # With caching
         if message is None:
-            return
+            return False
 
         if not message.startswith("S: "):
             self.logger.warning("Unexpected message: " + message)
-            return
+            return True
 
         message = message[3:]
         port_name, value = message.split(" ", 1)
         if port_name not in self.objects:
             self.logger.warning("Received message for unknown port: " + message)
-            return
+            return True
 
         port = self.objects[port_name]
-        await port.set_value(value)
+        try:
+            await port.set_value(value)
+        except ValueError:
+            self.logger.warning("Malformed update for " + message)
+            return True
+        # A write to an I2C register is news even if the value stays the same
+        self._publish(port, f"reg{port._last_register}" if isinstance(port, FtSwarmI2C) else None)
+        await self.rules.dispatch(port)
+        return True
 
     async def input_loop(self):
         while True:
-            await self.queue_use()
-            await asyncio.sleep(0.2)
+            # Work through the backlog at full speed, only poll slowly while the swarm is quiet
+            if await self.queue_use():
+                await asyncio.sleep(0)
+            else:
+                await asyncio.sleep(0.2)
 
     @staticmethod
     def _stringify_param(param):
@@ -58,13 +170,33 @@ class FtSwarm(FtSwarmBase):
     def _build_command(self, port_name, command, params):
         return f"{port_name}.{command}({','.join(map(self._stringify_param, params))})"
 
+    # Ports sending "S: " updates, their values are mirrored to the shared table
+    SUBSCRIBED_TYPES = (FtSwarmInput, FtSwarmJoystick, FtSwarmI2C)
+
+    def _publish(self, port: FtSwarmIO, written: str | None = None) -> None:
+        """
+        Mirror the fields of port that changed to the shared table
+        :param written: field to publish even if its value didn't change
+        """
+        if self.shared_table is None or not isinstance(port, self.SUBSCRIBED_TYPES):
+            return
+        for field, value in port.get_cached_values().items():
+            key = Snapshot.key(port._port_name, field)
+            if isinstance(value, int) and (field == written or self._published.get(key) != value):
+                self._published[key] = value
+                self.shared_table.publish(key, value)
+
     async def _get_object(self, port_name: str, clazz: type, *args):
         if port_name in self.objects:
             return self.objects[port_name]
 
         obj = clazz(self, port_name, *args)
+        if self.shared_table is not None and isinstance(obj, self.SUBSCRIBED_TYPES):
+            for field in obj.get_cached_values():
+                self.shared_table.register(Snapshot.key(port_name, field))
         await obj.post_init()
         self.objects[port_name] = obj
+        self._publish(obj)
         return obj
 
     async def get_digital_input(self, port_name: str) -> FtSwarmDigitalInput:
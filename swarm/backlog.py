@@ -0,0 +1,126 @@
+import asyncio
+from collections import OrderedDict
+from enum import Enum
+from itertools import count
+
+
+class OverflowPolicy(Enum):
+    """What to do with the cli backlog once it is full"""
+    DROP_OLDEST = "drop-oldest"
+    COALESCE = "coalesce"
+    BLOCK = "block"
+
+
+class Backlog:
+    """
+    Bounded buffer for unsolicited messages (mostly "S: " subscription updates) received while waiting for a reply
+
+    DROP_OLDEST discards the oldest message to make room for a new one.
+    COALESCE keeps only the latest "S: " value per port and drops the oldest message only if that is not enough.
+    BLOCK makes put() wait until the consumer has made room again.
+    """
+
+    def __init__(self, maxsize: int = 256, policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST) -> None:
+        if maxsize <= 0:
+            raise ValueError("maxsize must be positive")
+
+        self.maxsize = maxsize
+        self.policy = OverflowPolicy(policy)
+        self._entries: OrderedDict[object, str] = OrderedDict()
+        self._keys = count()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        self._not_empty = asyncio.Event()
+
+        self.size_bytes = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.high_water = 0
+        self.high_water_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def full(self) -> bool:
+        return len(self._entries) >= self.maxsize
+
+    def _key(self, message: str):
+        if self.policy is OverflowPolicy.COALESCE and message.startswith("S: "):
+            return message[3:].split(" ", 1)[0]
+        return next(self._keys)
+
+    def put_nowait(self, message: str) -> bool:
+        """
+        Add a message without waiting, dropping the oldest one if the backlog is full
+        :return: False if a message had to be dropped
+        """
+        key = self._key(message)
+        if key in self._entries:
+            # Keep the position of the old value so a busy port can't starve the others
+            self.size_bytes += len(message) - len(self._entries[key])
+            self._entries[key] = message
+            self.coalesced += 1
+            self._update_high_water()
+            return True
+
+        kept = True
+        if self.full():
+            _, oldest = self._entries.popitem(last=False)
+            self.size_bytes -= len(oldest)
+            self.dropped += 1
+            kept = False
+
+        self._entries[key] = message
+        self.size_bytes += len(message)
+        self._not_empty.set()
+        self._update_high_water()
+        return kept
+
+    async def put(self, message: str) -> bool:
+        """
+        Add a message, waiting for room if the policy is BLOCK
+        :return: False if a message had to be dropped
+        """
+        if self.policy is OverflowPolicy.BLOCK:
+            while self.full():
+                self._not_full.clear()
+                await self._not_full.wait()
+        return self.put_nowait(message)
+
+    def get_nowait(self) -> str | None:
+        """
+        Pop the oldest message
+        :return: the message or None if the backlog is empty
+        """
+        if not self._entries:
+            return None
+
+        _, message = self._entries.popitem(last=False)
+        self.size_bytes -= len(message)
+        self._not_full.set()
+        if not self._entries:
+            self._not_empty.clear()
+        return message
+
+    async def wait_not_empty(self) -> None:
+        await self._not_empty.wait()
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.size_bytes = 0
+        self._not_full.set()
+        self._not_empty.clear()
+
+    def _update_high_water(self) -> None:
+        self.high_water = max(self.high_water, len(self._entries))
+        self.high_water_bytes = max(self.high_water_bytes, self.size_bytes)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "size_bytes": self.size_bytes,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "high_water": self.high_water,
+            "high_water_bytes": self.high_water_bytes,
+        }
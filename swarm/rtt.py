@@ -0,0 +1,73 @@
+import time
+from collections import deque
+
+
+class RttEstimator:
+    """
+    Smoothed round trip time of the serial link, used for default reply timeouts
+
+    Follows the retransmission timer of RFC 6298: timeout = srtt + 4 * rttvar, doubled on every
+    timeout until a fresh sample arrives. Like the RFC the timeout never drops below one second by default,
+    a fast link would otherwise turn every hiccup of the swarm into a timeout. Calls taking longer than slow_factor * srtt are recorded
+    as slow calls, a growing number of them usually means a bad cable or an overloaded swarm.
+    """
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+
+    def __init__(self, initial_timeout: float = 1.0, min_timeout: float = 1.0, max_timeout: float = 10.0,
+                 slow_factor: float = 4.0, slow_history: int = 32) -> None:
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.slow_factor = slow_factor
+
+        self.srtt: float | None = None
+        self.rttvar: float | None = None
+        self._timeout = initial_timeout
+
+        self.calls = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.max_rtt = 0.0
+        self.slow_calls: deque[tuple[float, str, float]] = deque(maxlen=slow_history)
+        self.slow_count = 0
+
+    def timeout(self) -> float:
+        return self._timeout
+
+    def sample(self, cmd: str, rtt: float) -> None:
+        """Feed the round trip time of a successful call"""
+        self.calls += 1
+        self.max_rtt = max(self.max_rtt, rtt)
+
+        if self.srtt is not None and rtt > self.slow_factor * self.srtt:
+            self.slow_calls.append((time.time(), cmd, rtt))
+            self.slow_count += 1
+
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+
+        self._timeout = min(self.max_timeout, max(self.min_timeout, self.srtt + 4 * self.rttvar))
+
+    def timed_out(self, cmd: str) -> None:
+        # Karn's algorithm: no sample from a call without reply, back off instead
+        self.timeouts += 1
+        self.slow_calls.append((time.time(), cmd, float("inf")))
+        self.slow_count += 1
+        self._timeout = min(self.max_timeout, self._timeout * 2)
+
+    def stats(self) -> dict[str, float | int | None]:
+        return {
+            "srtt": self.srtt,
+            "rttvar": self.rttvar,
+            "timeout": self._timeout,
+            "calls": self.calls,
+            "timeouts": self.timeouts,
+            "cancelled": self.cancelled,
+            "max_rtt": self.max_rtt,
+            "slow_calls": self.slow_count,
+        }
@@ -0,0 +1,280 @@
+import inspect
+from typing import Any, Callable
+
+from .swarm import FtSwarmActor, FtSwarmI2C, FtSwarmInput, FtSwarmIO, FtSwarmJoystick, FtSwarmPixel, \
+    FtSwarmServo, Trigger
+
+
+class Rule:
+    """
+    A reaction to a trigger event, built with when()
+
+    Rules the firmware can express are compiled to onTrigger commands and run on the controller,
+    everything else is evaluated on the host whenever a subscription update for the source arrives.
+    Await the rule (or pass it to RuleEngine.install) to activate it.
+    """
+
+    def __init__(self, source: FtSwarmIO, axis: str | None, trigger: Trigger, threshold: int | None,
+                 target: FtSwarmIO | None, command: str | None, value: int | None,
+                 callback: Callable[[Any], Any] | None) -> None:
+        self.source = source
+        self.axis = axis
+        self.trigger = trigger
+        self.threshold = threshold
+        self.target = target
+        self.command = command
+        self.value = value
+        self.callback = callback
+        self.compiled = False
+
+    def __await__(self):
+        yield from self.source._swarm.rules.install(self).__await__()
+        return self
+
+    def is_compilable(self) -> bool:
+        """Whether the firmware can run this rule on its own"""
+        if self.threshold is not None or self.callback is not None:
+            return False
+        if not isinstance(self.target, FtSwarmActor) or self.command != "setSpeed":
+            return False
+        if isinstance(self.source, FtSwarmJoystick):
+            return self.axis in ("lr", "fb") and self.trigger in (Trigger.TRIGGERUP, Trigger.TRIGGERDOWN,
+                                                                 Trigger.TRIGGERVALUE)
+        if isinstance(self.source, FtSwarmI2C):
+            return self.trigger in (Trigger.TRIGGERI2CREAD, Trigger.TRIGGERI2CWRITE)
+        if isinstance(self.source, FtSwarmInput):
+            return self.trigger in (Trigger.TRIGGERUP, Trigger.TRIGGERDOWN, Trigger.TRIGGERVALUE)
+        return False
+
+    def slot(self) -> tuple[str, str | None, Trigger]:
+        """The firmware keeps one trigger per port, axis and event"""
+        return self.source._port_name, self.axis, self.trigger
+
+    def trigger_command(self) -> tuple[str, tuple]:
+        """The onTrigger command for the source port, sent again after a reconnect"""
+        command = {"lr": "onTriggerLR", "fb": "onTriggerFB"}.get(self.axis, "onTrigger")
+        return command, (self.trigger, self.target._port_name) + (() if self.value is None else (self.value,))
+
+    async def compile(self) -> None:
+        command, args = self.trigger_command()
+        await self.source._swarm.send(self.source._port_name, command, *args)
+        self.compiled = True
+
+    def check(self) -> None:
+        """
+        Make sure the host can see the rule's event
+        :raises ValueError: if the trigger doesn't fit the source or only the firmware can observe it
+        """
+        i2c_trigger = self.trigger in (Trigger.TRIGGERI2CREAD, Trigger.TRIGGERI2CWRITE)
+        if isinstance(self.source, FtSwarmI2C) != i2c_trigger:
+            raise ValueError("read() and written() are the only events of an I2C port")
+        if self.trigger == Trigger.TRIGGERI2CREAD and not self.is_compilable():
+            raise ValueError("Register reads are only seen by the ftSwarm, the reaction must be an actor speed")
+
+    def read(self) -> int | None:
+        if isinstance(self.source, FtSwarmJoystick):
+            return self.source._lr if self.axis == "lr" else self.source._fb
+        if isinstance(self.source, FtSwarmInput):
+            return self.source._value
+        if isinstance(self.source, FtSwarmI2C):
+            return self.source.get_cached_values().get(f"reg{self.source._last_register}")
+        return None
+
+    def fires(self, previous: int | None, current: int | None) -> bool:
+        if isinstance(self.source, FtSwarmI2C):
+            # Every update of an I2C port is a write by the master
+            return self.trigger == Trigger.TRIGGERI2CWRITE
+        if current is None:
+            # No comparable value (e.g. I2C), every update is an event
+            return True
+        if previous is None or previous == current:
+            return False
+        if self.threshold is not None:
+            if self.trigger == Trigger.TRIGGERUP:
+                return previous <= self.threshold < current
+            return previous >= self.threshold > current
+        if self.trigger == Trigger.TRIGGERUP:
+            return not previous and bool(current)
+        if self.trigger == Trigger.TRIGGERDOWN:
+            return bool(previous) and not current
+        return True
+
+    async def run(self, current: int | None) -> None:
+        if self.callback is not None:
+            result = self.callback(current)
+            if inspect.isawaitable(result):
+                await result
+            return
+
+        value = current if self.value is None else self.value
+        if self.command == "setPosition":
+            await self.target.set_position(value)
+        elif self.command == "setColor":
+            await self.target.set_color(value)
+        else:
+            await self.target._swarm.send(self.target._port_name, self.command, value)
+
+
+class RuleBuilder:
+    """
+    First half of a rule: when(source).up()
+
+    Don't create this class directly, use when() instead
+    """
+
+    def __init__(self, source: FtSwarmIO, axis: str | None = None) -> None:
+        if axis is not None and axis not in ("lr", "fb"):
+            raise ValueError("axis must be 'lr' or 'fb'")
+        if isinstance(source, FtSwarmJoystick) and axis is None:
+            raise ValueError("Joystick rules need an axis ('lr' or 'fb')")
+
+        self._source = source
+        self._axis = axis
+        self._trigger = Trigger.TRIGGERI2CWRITE if isinstance(source, FtSwarmI2C) else Trigger.TRIGGERVALUE
+        self._threshold = None
+
+    def up(self) -> "RuleBuilder":
+        self._trigger = Trigger.TRIGGERUP
+        return self
+
+    def down(self) -> "RuleBuilder":
+        self._trigger = Trigger.TRIGGERDOWN
+        return self
+
+    def changes(self) -> "RuleBuilder":
+        self._trigger = Trigger.TRIGGERVALUE
+        return self
+
+    def above(self, threshold: int) -> "RuleBuilder":
+        """Fire when the value rises past threshold (host-side only)"""
+        self._trigger = Trigger.TRIGGERUP
+        self._threshold = threshold
+        return self
+
+    def below(self, threshold: int) -> "RuleBuilder":
+        """Fire when the value falls past threshold (host-side only)"""
+        self._trigger = Trigger.TRIGGERDOWN
+        self._threshold = threshold
+        return self
+
+    def read(self) -> "RuleBuilder":
+        self._trigger = Trigger.TRIGGERI2CREAD
+        return self
+
+    def written(self) -> "RuleBuilder":
+        self._trigger = Trigger.TRIGGERI2CWRITE
+        return self
+
+    def then(self, target: FtSwarmIO) -> "ActionBuilder":
+        return ActionBuilder(self, target)
+
+    def call(self, callback: Callable[[Any], Any]) -> Rule:
+        """Run callback(value) on the host, it may be a coroutine function"""
+        return self._build(None, None, None, callback)
+
+    def _build(self, target, command, value, callback=None) -> Rule:
+        return Rule(self._source, self._axis, self._trigger, self._threshold, target, command, value, callback)
+
+
+class ActionBuilder:
+    """
+    Second half of a rule: .then(motor).speed(200)
+
+    Don't create this class directly, use RuleBuilder.then() instead
+    """
+
+    def __init__(self, rule: RuleBuilder, target: FtSwarmIO) -> None:
+        self._rule = rule
+        self._target = target
+
+    def speed(self, speed: int) -> Rule:
+        self._check_actor("speed()")
+        return self._rule._build(self._target, "setSpeed", speed)
+
+    def on(self, power: int = 255) -> Rule:
+        return self.speed(power)
+
+    def off(self) -> Rule:
+        return self.speed(0)
+
+    def follow(self) -> Rule:
+        """Pass the sensor value on to the actor"""
+        self._check_actor("follow()")
+        return self._rule._build(self._target, "setSpeed", None)
+
+    def position(self, position: int) -> Rule:
+        if not isinstance(self._target, FtSwarmServo):
+            raise TypeError("position() needs a servo as target")
+        return self._rule._build(self._target, "setPosition", position)
+
+    def color(self, color: int) -> Rule:
+        if not isinstance(self._target, FtSwarmPixel):
+            raise TypeError("color() needs a pixel as target")
+        return self._rule._build(self._target, "setColor", color)
+
+    def _check_actor(self, action: str) -> None:
+        if not isinstance(self._target, FtSwarmActor):
+            raise TypeError(f"{action} needs an actor (motor, lamp, valve, ...) as target")
+
+
+def when(source: FtSwarmIO, axis: str | None = None) -> RuleBuilder:
+    """
+    Start a declarative rule, e.g. await when(switch).up().then(motor).speed(200)
+
+    :param source: input, joystick or I2C object the rule listens to
+    :param axis: "lr" or "fb", only for joysticks
+    """
+    return RuleBuilder(source, axis)
+
+
+class RuleEngine:
+    """
+    Installs rules and evaluates the ones the firmware can't run
+
+    Every FtSwarm has one at FtSwarm.rules
+    """
+
+    def __init__(self) -> None:
+        self.host_rules: dict[str, list[Rule]] = {}
+        self.compiled_rules: dict[tuple, Rule] = {}
+        self._last_values: dict[tuple, int | None] = {}
+
+    async def install(self, *rules: Rule) -> list[Rule]:
+        """
+        Compile or register rules
+
+        :raises ValueError: if the firmware trigger for the rule's port and event is already taken
+        """
+        for rule in rules:
+            rule.check()
+            if rule.is_compilable():
+                if rule.slot() in self.compiled_rules:
+                    port_name, axis, trigger = rule.slot()
+                    raise ValueError(f"{port_name}{'.' + axis if axis else ''} already has a rule for {trigger.name}, "
+                                     f"the ftSwarm runs only one reaction per event")
+                await rule.compile()
+                self.compiled_rules[rule.slot()] = rule
+            else:
+                self.host_rules.setdefault(rule.source._port_name, []).append(rule)
+                self._last_values[(rule.source._port_name, rule.axis)] = rule.read()
+        return list(rules)
+
+    async def dispatch(self, port: FtSwarmIO) -> None:
+        """Evaluate the host-side rules of port, call this after every value update"""
+        rules = self.host_rules.get(port._port_name)
+        if not rules:
+            return
+
+        current_values = {}
+        for rule in rules:
+            key = (port._port_name, rule.axis)
+            if key not in current_values:
+                current_values[key] = rule.read()
+            if rule.fires(self._last_values.get(key), current_values[key]):
+                try:
+                    await rule.run(current_values[key])
+                except Exception:
+                    # One broken rule must not stop the updates of every port
+                    port._swarm.logger.exception(f"Rule on {port._port_name} failed")
+
+        self._last_values.update(current_values)
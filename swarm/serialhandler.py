@@ -1,24 +1,91 @@
 import asyncio
+import time
 from logging import Logger
 from asyncio.locks import Lock
+from typing import Awaitable, Callable
 import serial
 
+from .backlog import Backlog, OverflowPolicy
+from .rtt import RttEstimator
+
 
 class SerialHandler:
-    def __init__(self, port: str, logger: Logger):
+    def __init__(self, port: str, logger: Logger, backlog_size: int = 256,
+                 overflow_policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST, reconnect: bool = True,
+                 max_held_commands: int = 32, hold_timeout: float = 5.0):
+        """
+        :param reconnect: reopen the port after the link dropped instead of failing every call
+        :param max_held_commands: commands waiting for the link to come back, more fail right away
+        :param hold_timeout: seconds a command waits for the link before it fails
+        """
         self.logger = logger
-        self.ser = serial.Serial(port, 115200, timeout=5)
+        self.port = port
+        self.ser = self._open_port()
         # self.ser.set_buffer_size(rx_size=1024, tx_size=1024)
         self.lock = Lock()
-        self.message_queue = asyncio.Queue()
+        self.message_queue = Backlog(backlog_size, overflow_policy)
+        self.rtt = RttEstimator()
+        self._rx_buffer = bytearray()
+        self._pending_replies = 0
+        self._abandoned_replies = 0
+        self._abandoned_until = 0.0
+        # Seconds to wait for replies of abandoned calls before giving them up, None uses the RTT timeout
+        self.resync_interval: float | None = None
+
+        self.reconnect = reconnect
+        self.max_held_commands = max_held_commands
+        self.hold_timeout = hold_timeout
+        self.reconnect_delay = 0.05
+        self.max_reconnect_delay = 2.0
+        # Called with the lock held after reopening, gets a send_batch(cmds, wait_for_return) to restore the setup
+        self.on_reconnect: Callable[[Callable], Awaitable[None]] | None = None
+        self.connected = asyncio.Event()
+        self.connected.set()
+        self._reconnect_task: asyncio.Task | None = None
+        self._lost_at = 0.0
+        self._held_commands = 0
+
+        self.disconnects = 0
+        self.replayed_commands = 0
+        self.rejected_commands = 0
+        self.last_recovery_time: float | None = None
+        self.max_recovery_time = 0.0
+        self.reconnect_attempts = 0
+        self.last_reconnect_error: str | None = None
+
+    def configure(self, backlog_size: int | None = None, overflow_policy: OverflowPolicy | None = None,
+                  reconnect: bool | None = None, min_reply_timeout: float | None = None) -> None:
+        """
+        Change the options given to the constructor, FtSwarm uses this so handlers only need (port, logger)
+        :param min_reply_timeout: lower bound of the default reply timeout, however fast the link measures
+        """
+        if backlog_size is not None or overflow_policy is not None:
+            self.message_queue = Backlog(backlog_size or self.message_queue.maxsize,
+                                         overflow_policy or self.message_queue.policy)
+        if reconnect is not None:
+            self.reconnect = reconnect
+        if min_reply_timeout is not None:
+            self.rtt.min_timeout = min_reply_timeout
 
-    def try_reboot(self):
+    def _open_port(self) -> serial.Serial:
+        return serial.Serial(self.port, 115200, timeout=5)
+
+    def try_reboot(self, timeout: float | None = 10.0):
+        """
+        Start the CLI of the ftSwarm
+        :param timeout: seconds until SerialException if the ftSwarm doesn't answer, None waits forever
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
         self.ser.write(b"startCLI\r\n")
         while self.ser.in_waiting <= 0:
-            pass
+            if deadline is not None and time.monotonic() > deadline:
+                raise serial.SerialException("No answer from the ftSwarm")
+            time.sleep(0.01)
 
         self.logger.info("Message from the ftSwarm")
         while True:
+            if deadline is not None and time.monotonic() > deadline:
+                raise serial.SerialException("ftSwarm CLI did not start")
             message = self.ser.read_until(serial.LF)
             # noinspection PyBroadException
             try:
@@ -29,52 +96,350 @@ class SerialHandler:
                 pass
 
         self.ser.read_all()
+        self._rx_buffer.clear()
+
+    async def send_and_wait(self, cmd: str, wait_for_return=True, timeout: float | None = None):
+        """
+        Send a command and wait for its "R: " reply
+
+        :param timeout: seconds until TimeoutError, including the wait for the lock. Without it the lock is waited
+                        for as long as it takes and the reply for the adaptive timeout of the RTT estimator
+        """
+        deadline = await self._acquire_link(cmd, timeout, self.rtt.timeout)
+        try:
+            return await self._send_and_wait(cmd, wait_for_return, deadline)
+        finally:
+            self.lock.release()
+
+    async def send_batch(self, cmds: list[str], timeout: float | None = None) -> list[str]:
+        """
+        Send several commands in one write and collect their replies in order
+
+        The ftSwarm answers strictly in order, so pipelining saves a round trip per command.
+        :param timeout: seconds until TimeoutError for the whole batch including the wait for the lock, defaults to
+                        the adaptive timeout per command for the replies only
+        """
+        if not cmds:
+            return []
+
+        label = f"{len(cmds)} commands"
+        deadline = await self._acquire_link(label, timeout, lambda: self.rtt.timeout() * len(cmds))
+        try:
+            if not self.ser.is_open:
+                raise serial.SerialException("Serial port is not open")
+            return await self._send_batch(cmds, [True] * len(cmds), deadline)
+        finally:
+            self.lock.release()
+
+    async def _send_batch(self, cmds: list[str], wait_for_return: list[bool], deadline: float) -> list[str | None]:
+        await self._resync()
+        for cmd in cmds:
+            self.logger.debug("Swarm <- " + cmd)
+        self._write(b"".join(cmd.encode("UTF-8") + b"\r\n" for cmd in cmds))
+
+        replies = iter(await self._collect_replies(sum(wait_for_return), deadline, f"{len(cmds)} commands"))
+        return [next(replies) if wait else None for wait in wait_for_return]
+
+    async def _acquire_link(self, label: str, timeout: float | None, default_timeout: Callable[[], float]) -> float:
+        """
+        Wait until the link is up and the lock is held
 
-    async def send_and_wait(self, cmd: str, wait_for_return=True):
-        async with self.lock:
-            return await self._send_and_wait(cmd, wait_for_return)
+        An explicit timeout covers the wait for the link and the lock as well, the default only starts once the lock
+        is held: queueing behind other commands or an outage is no sign of a slow link.
+        :return: deadline for the command
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            await self._wait_for_link(label, deadline)
+            remaining = None if deadline is None else max(0.0, deadline - loop.time())
+            if not await self._acquire_lock(remaining):
+                raise TimeoutError(f"Timed out waiting for the serial port to send {label}")
+            if self.connected.is_set():
+                return loop.time() + default_timeout() if deadline is None else deadline
+            # The link dropped while waiting for the lock
+            self.lock.release()
+
+    async def _wait_for_link(self, label: str, deadline: float | None = None) -> None:
+        """
+        Hold a command while the link is down, for hold_timeout or until the caller's deadline, whichever comes first
+        :raises TimeoutError: if the caller's deadline ran out
+        :raises serial.SerialException: if the link stays down for hold_timeout or can't be reopened
+        """
+        if self.connected.is_set():
+            return
+        if not self.reconnect:
+            raise serial.SerialException("Serial port is not open")
+        if self._held_commands >= self.max_held_commands:
+            self.rejected_commands += 1
+            raise serial.SerialException(f"Serial link is down, too many commands waiting to send {label}")
+
+        loop = asyncio.get_running_loop()
+        hold_timeout = self.hold_timeout
+        caller_limited = deadline is not None and deadline - loop.time() < hold_timeout
+        if caller_limited:
+            hold_timeout = max(0.0, deadline - loop.time())
+
+        self._held_commands += 1
+        try:
+            await asyncio.wait_for(self.connected.wait(), hold_timeout)
+        except asyncio.TimeoutError:
+            self.rejected_commands += 1
+            if caller_limited:
+                raise TimeoutError(f"Timed out waiting for the serial link to send {label}") from None
+            raise serial.SerialException(f"Serial link is still down, giving up on {label}") from None
+        finally:
+            self._held_commands -= 1
+        self.replayed_commands += 1
+
+    async def _acquire_lock(self, timeout: float | None) -> bool:
+        # asyncio.wait_for(lock.acquire()) can leave the lock held when the timeout races the acquisition
+        acquire = asyncio.ensure_future(self.lock.acquire())
+        try:
+            done, _ = await asyncio.wait({acquire}, timeout=timeout)
+        except asyncio.CancelledError:
+            self._abort_acquire(acquire)
+            raise
 
-    async def _send_and_wait(self, cmd: str, wait_for_return):
+        if not done:
+            self._abort_acquire(acquire)
+            return False
+        return True
+
+    def _abort_acquire(self, acquire: asyncio.Future) -> None:
+        if acquire.done() and not acquire.cancelled():
+            self.lock.release()
+        else:
+            acquire.cancel()
+
+    async def _send_and_wait(self, cmd: str, wait_for_return, deadline: float | None = None):
         if not self.ser.is_open:
             raise serial.SerialException("Serial port is not open")
 
+        await self._resync()
         self.logger.debug("Swarm <- " + cmd)
-        self.ser.write(cmd.encode("UTF-8") + b"\r\n")
+        self._write(cmd.encode("UTF-8") + b"\r\n")
 
         if not wait_for_return:
             return
 
-        while True:
+        loop = asyncio.get_running_loop()
+        sent_at = loop.time()
+        reply = (await self._collect_replies(1, deadline, cmd))[0]
+        self.rtt.sample(cmd, loop.time() - sent_at)
+        return reply
+
+    async def _collect_replies(self, count: int, deadline: float | None, label: str) -> list[str]:
+        self._pending_replies = count
+        try:
+            remaining = None if deadline is None else max(0.0, deadline - asyncio.get_running_loop().time())
+            return await asyncio.wait_for(self._wait_for_replies(count), remaining)
+        except asyncio.TimeoutError:
+            self.rtt.timed_out(label)
+            raise TimeoutError(f"No reply from the ftSwarm for {label}") from None
+        except asyncio.CancelledError:
+            self.rtt.cancelled += 1
+            raise
+        finally:
+            # Missing replies may still arrive, they must not be taken for the answer to the next command
+            if self._pending_replies > 0:
+                self._abandoned_replies += self._pending_replies
+                interval = self.rtt.timeout() if self.resync_interval is None else self.resync_interval
+                self._abandoned_until = asyncio.get_running_loop().time() + interval
+            self._pending_replies = 0
+
+    async def _resync(self) -> None:
+        """
+        Settle the replies of abandoned calls before sending, called with the lock held
+
+        Nothing has been sent yet, so every "R: " arriving now is a late reply. Replies that haven't shown up
+        within the resync interval are taken as lost, otherwise one lost reply would shift all later ones.
+        """
+        loop = asyncio.get_running_loop()
+        while self._abandoned_replies > 0:
+            message = await self._get_message(queue=False)  # Discards late replies
+            if message is not None:
+                if not await self.message_queue.put(message):
+                    self.logger.debug("CLI backlog full, dropped oldest message")
+                continue
+
+            if loop.time() >= self._abandoned_until:
+                self.logger.warning(f"{self._abandoned_replies} replies from the ftSwarm got lost, resynchronised")
+                self._abandoned_replies = 0
+                break
+            await asyncio.sleep(0.01)
+
+    async def _wait_for_replies(self, count: int) -> list[str]:
+        replies = []
+        while len(replies) < count:
             message = await self._get_message(queue=False)  # Queueing is only for building the cli backlog
             if message is None:
                 await asyncio.sleep(0.01)
                 continue
 
             if message.startswith("R: "):
-                return message[3:]
-            else:
-                self.message_queue.put_nowait(message)
+                self._pending_replies -= 1
+                replies.append(message[3:])
+            elif not await self.message_queue.put(message):
+                self.logger.debug("CLI backlog full, dropped oldest message")
+        return replies
 
     async def get_message(self) -> str | None:
-        async with self.lock:
+        # The backlog can be drained without the lock, a sender blocked on a full backlog is holding it
+        message = self.message_queue.get_nowait()
+        if message is not None:
+            return message
+
+        if not self.connected.is_set() and self.reconnect:
+            return
+
+        # Whatever a sender queues while we wait for the lock is ours too, it may be waiting for us to make room
+        acquire = asyncio.ensure_future(self.lock.acquire())
+        queued = asyncio.ensure_future(self.message_queue.wait_not_empty())
+        try:
+            await asyncio.wait({acquire, queued}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            self._abort_acquire(acquire)
+            raise
+        finally:
+            queued.cancel()
+
+        if not acquire.done():
+            self._abort_acquire(acquire)
+            return self.message_queue.get_nowait()
+
+        try:
             return await self._get_message()
+        except serial.SerialException:
+            if not self.reconnect:
+                raise
+            return  # The link is being restored, there is nothing to read until then
+        finally:
+            self.lock.release()
 
     async def _get_message(self, queue=True) -> str | None:
         if not self.ser.is_open:
             raise serial.SerialException("Serial port is not open")
 
-        if self.message_queue.qsize() > 0 and queue:
+        if len(self.message_queue) > 0 and queue:
             return self.message_queue.get_nowait()  # Prioritize queue
 
-        if self.ser.in_waiting <= 0:
+        while True:
+            message = self._read_line()
+            if message is None:
+                return
+
+            if message.startswith("R: ") and self._abandoned_replies > 0:
+                self._abandoned_replies -= 1
+                self.logger.debug("Discarding late reply: " + message)
+                continue
+
+            return message
+
+    def _read_line(self) -> str | None:
+        # Only read what is already there, a blocking read would stall the event loop
+        try:
+            if b"\n" not in self._rx_buffer and self.ser.in_waiting > 0:
+                self._rx_buffer += self.ser.read(self.ser.in_waiting)
+        except (serial.SerialException, OSError) as e:
+            self._link_lost(e)
+            raise serial.SerialException("Serial link lost") from e
+
+        line, separator, rest = self._rx_buffer.partition(b"\n")
+        if not separator:
             return
 
-        # Get message
-        rest = self.ser.read_until(serial.LF)
-        message = rest.removesuffix(b"\n").removesuffix(b"\r").decode("UTF-8")
+        self._rx_buffer = rest
+        message = line.removesuffix(b"\r").decode("UTF-8")
         self.logger.debug("Swarm -> " + message)
 
         return message
 
+    def _write(self, data: bytes) -> None:
+        try:
+            self.ser.write(data)
+        except (serial.SerialException, OSError) as e:
+            self._link_lost(e)
+            raise serial.SerialException("Serial link lost") from e
+
+    def _link_lost(self, error: Exception) -> None:
+        if not self.reconnect or not self.connected.is_set():
+            return
+
+        self.logger.warning(f"Lost connection to the ftSwarm: {error}")
+        self.connected.clear()
+        self.disconnects += 1
+        self._lost_at = time.monotonic()
+        # noinspection PyBroadException
+        try:
+            self.ser.close()
+        except Exception:
+            pass
+        self._reconnect_task = asyncio.get_running_loop().create_task(self._reconnect())
+
+    def _reopen(self) -> None:
+        self.ser = self._open_port()
+        self.try_reboot(timeout=self.hold_timeout)
+
+    async def _reconnect(self) -> None:
+        delay = self.reconnect_delay
+        while True:
+            self.reconnect_attempts += 1
+            try:
+                # Opening the port and starting the CLI block, keep the event loop running meanwhile
+                await asyncio.to_thread(self._reopen)
+                async with self.lock:
+                    self._rx_buffer.clear()
+                    self._pending_replies = 0
+                    self._abandoned_replies = 0
+                    if self.on_reconnect is not None:
+                        await self.on_reconnect(self._resubscribe_batch)
+                    self.connected.set()
+                break
+            except Exception as e:
+                self.last_reconnect_error = repr(e)
+                if isinstance(e, (serial.SerialException, OSError, TimeoutError)):
+                    self.logger.debug(f"Reconnecting to the ftSwarm failed: {e}")
+                else:
+                    # A bug in on_reconnect must not end the task, the link would never come back
+                    self.logger.exception("Restoring the ftSwarm setup after reconnecting failed")
+                # noinspection PyBroadException
+                try:
+                    self.ser.close()
+                except Exception:
+                    pass
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+
+        self.last_recovery_time = time.monotonic() - self._lost_at
+        self.max_recovery_time = max(self.max_recovery_time, self.last_recovery_time)
+        self.logger.info(f"Reconnected to the ftSwarm after {self.last_recovery_time:.3f}s")
+
+    async def _resubscribe_batch(self, cmds: list[str], wait_for_return: list[bool]) -> list[str | None]:
+        deadline = asyncio.get_running_loop().time() + self.rtt.timeout() * max(1, len(cmds))
+        return await self._send_batch(cmds, wait_for_return, deadline)
+
+    def link_stats(self) -> dict[str, float | int | bool | None]:
+        return {
+            "connected": self.connected.is_set(),
+            "disconnects": self.disconnects,
+            "held": self._held_commands,
+            "replayed": self.replayed_commands,
+            "rejected": self.rejected_commands,
+            "last_recovery_time": self.last_recovery_time,
+            "max_recovery_time": self.max_recovery_time,
+            "reconnect_attempts": self.reconnect_attempts,
+            "last_reconnect_error": self.last_reconnect_error,
+        }
+
+    def rtt_stats(self) -> dict[str, float | int | None]:
+        return self.rtt.stats()
+
+    def backlog_stats(self) -> dict[str, int]:
+        return self.message_queue.stats()
+
     def close(self):
+        self.reconnect = False
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
         self.ser.close()
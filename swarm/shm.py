@@ -0,0 +1,156 @@
+import mmap
+import os
+import struct
+import time
+
+MAGIC = b"FTSW"
+VERSION = 1
+
+# magic, version, capacity, number of used slots
+HEADER = struct.Struct("<4sIII")
+# seqlock counter, value, timestamp, port name - one cache line per port
+SLOT = struct.Struct("<Qqd40s")
+SEQ = struct.Struct("<Q")
+DATA = struct.Struct("<qd")
+COUNT_OFFSET = 12
+NAME_LENGTH = 40
+# A slot still mid-write after this many attempts belongs to a writer that died
+MAX_READ_ATTEMPTS = 10000
+
+
+def table_size(capacity: int) -> int:
+    return HEADER.size + capacity * SLOT.size
+
+
+class SharedSnapshotWriter:
+    """
+    Owner side of the shared sensor table
+
+    The process running the FtSwarm writes the latest value and timestamp of every subscribed port to a
+    memory mapped file, other processes attach a SharedSnapshotReader to the same path. Every slot is
+    guarded by a seqlock: the counter is odd while a write is in progress, so readers never need a lock.
+
+    Python can't issue memory barriers, the seqlock relies on the CPU keeping stores and loads in program order.
+    x86 does, so readers there always get a consistent value and timestamp. On ARM (e.g. a Raspberry Pi) a reader
+    in another process may rarely see a torn slot: a new value with the previous timestamp or the other way round.
+    """
+
+    def __init__(self, path: str, capacity: int = 64) -> None:
+        self.path = path
+        self.capacity = capacity
+        self._slots: dict[str, int] = {}
+        self._seq: list[int] = [0] * capacity
+
+        # Build the table in a new file and rename it into place, truncating the old one would crash its readers
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w+b") as file:
+            file.truncate(table_size(capacity))
+            self._mmap = mmap.mmap(file.fileno(), table_size(capacity))
+        HEADER.pack_into(self._mmap, 0, MAGIC, VERSION, capacity, 0)
+        os.replace(temp_path, path)
+
+    def register(self, port_name: str) -> int:
+        """Reserve a slot for port_name, called once per port before the first publish"""
+        if port_name in self._slots:
+            return self._slots[port_name]
+
+        encoded = port_name.encode("UTF-8")
+        if len(encoded) > NAME_LENGTH:
+            raise ValueError(f"Port name {port_name} is too long for the shared table ({NAME_LENGTH} bytes max)")
+        if len(self._slots) >= self.capacity:
+            raise ValueError(f"Shared table is full ({self.capacity} ports)")
+
+        index = len(self._slots)
+        SLOT.pack_into(self._mmap, self._offset(index), 0, 0, 0.0, encoded)
+        # Publish the count last, readers only look at slots below it
+        struct.pack_into("<I", self._mmap, COUNT_OFFSET, index + 1)
+        self._slots[port_name] = index
+        return index
+
+    def publish(self, port_name: str, value: int, timestamp: float | None = None) -> bool:
+        """
+        Write the latest value of a registered port
+        :return: False if the port has no slot
+        """
+        index = self._slots.get(port_name)
+        if index is None:
+            return False
+
+        offset = self._offset(index)
+        seq = self._seq[index]
+        SEQ.pack_into(self._mmap, offset, seq + 1)
+        DATA.pack_into(self._mmap, offset + SEQ.size, value, time.time() if timestamp is None else timestamp)
+        SEQ.pack_into(self._mmap, offset, seq + 2)
+        self._seq[index] = seq + 2
+        return True
+
+    @staticmethod
+    def _offset(index: int) -> int:
+        return HEADER.size + index * SLOT.size
+
+    def close(self) -> None:
+        self._mmap.close()
+
+
+class SharedSnapshotReader:
+    """
+    Read-only view of a table written by SharedSnapshotWriter, for use in other processes
+
+    Reads are plain memory accesses to the mapping, no system call is made per read. Slots are only guaranteed
+    consistent on x86, see SharedSnapshotWriter.
+    """
+
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.capacity, _ = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a ftSwarm shared table")
+
+        self._slots: dict[str, int] = {}
+        self._known = 0
+
+    def _refresh(self) -> None:
+        count = struct.unpack_from("<I", self._mmap, COUNT_OFFSET)[0]
+        for index in range(self._known, count):
+            name = SLOT.unpack_from(self._mmap, self._offset(index))[3]
+            self._slots[name.rstrip(b"\0").decode("UTF-8")] = index
+        self._known = count
+
+    def ports(self) -> list[str]:
+        self._refresh()
+        return list(self._slots)
+
+    def read(self, port_name: str) -> tuple[int, float]:
+        """
+        Latest value of a port
+        :return: (value, timestamp) - timestamp is 0.0 until the first update
+        """
+        index = self._slots.get(port_name)
+        if index is None:
+            self._refresh()
+            index = self._slots[port_name]
+
+        offset = self._offset(index)
+        for attempt in range(MAX_READ_ATTEMPTS):
+            before = SEQ.unpack_from(self._mmap, offset)[0]
+            if not before & 1:
+                value, timestamp = DATA.unpack_from(self._mmap, offset + SEQ.size)
+                if SEQ.unpack_from(self._mmap, offset)[0] == before:
+                    return value, timestamp
+            if attempt >= 100:
+                # The writer is stalled, stop competing with it for the CPU
+                time.sleep(0.0001)
+
+        raise RuntimeError(f"Slot of {port_name} is stuck in a write, is the writing process still alive?")
+
+    def __getitem__(self, port_name: str) -> int:
+        return self.read(port_name)[0]
+
+    @staticmethod
+    def _offset(index: int) -> int:
+        return HEADER.size + index * SLOT.size
+
+    def close(self) -> None:
+        self._mmap.close()
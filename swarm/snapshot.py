@@ -0,0 +1,35 @@
+from array import array
+
+
+class Snapshot:
+    """
+    Consistent view of all values cached by a swarm at one point in time
+
+    The values live in one compact int64 array, index maps "port" or "port.field" (e.g. "joystick.lr",
+    "pixel.color", "i2c.reg3") to a position in it. The array supports the buffer protocol, so
+    numpy.asarray(snapshot.values) or snapshot.to_bytes() hand it over without copying field by field.
+    """
+
+    def __init__(self, timestamp: float, index: dict[str, int], values: array) -> None:
+        self.timestamp = timestamp
+        self.index = index
+        self.values = values
+
+    @staticmethod
+    def key(port_name: str, field: str) -> str:
+        return f"{port_name}.{field}" if field else port_name
+
+    def __getitem__(self, key: str) -> int:
+        return self.values[self.index[key]]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def as_dict(self) -> dict[str, int]:
+        return {key: self.values[position] for key, position in self.index.items()}
+
+    def to_bytes(self) -> bytes:
+        return self.values.tobytes()
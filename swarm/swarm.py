@@ -69,7 +69,8 @@ class FtSwarmBase:
     def __init__(self) -> None:
         self.logger = logging.getLogger("swarm-base")
 
-    async def send(self, port_name: str, command: str, *args: str | int | float) -> int | str | None:
+    async def send(self, port_name: str, command: str, *args: str | int | float,
+                   timeout: float | None = None) -> int | str | None:
         pass
 
 
@@ -85,7 +86,17 @@ class FtSwarmIO:
         self._swarm = swarm
 
     async def post_init(self) -> None:
-        pass
+        for field, command, args in await self.get_setup_queries():
+            value = await self._swarm.send(self._port_name, command, *args)
+            if field is not None:
+                self.store_cached_value(field, value)
+
+    async def get_setup_queries(self) -> list[tuple[str | None, str, tuple]]:
+        """
+        Commands configuring the port, sent on creation and again after a reconnect
+        :return: list of (field, command, args), the reply is cached under field unless it is None
+        """
+        return []
 
     async def get_port_name(self) -> str:
         return self._port_name
@@ -93,6 +104,23 @@ class FtSwarmIO:
     async def set_value(self, value: str) -> None:
         self._swarm.logger.warning(f"Received unexpected write to {self._port_name}: {value}")
 
+    def get_cached_values(self) -> dict[str, int]:
+        """
+        Values cached on the host by field name, "" is the main value of the port
+        :return: field -> value
+        """
+        return {}
+
+    def get_refresh_queries(self) -> list[tuple[str, str, tuple]]:
+        """
+        Commands fetching the cached values that no subscription keeps up to date
+        :return: list of (field, command, args)
+        """
+        return []
+
+    def store_cached_value(self, field: str, value: int) -> None:
+        pass
+
 
 class FtSwarmActorShim(FtSwarmIO):
     """
@@ -101,7 +129,7 @@ class FtSwarmActorShim(FtSwarmIO):
     Don't use this class at all
     """
 
-    def get_port_name(self) -> str:
+    async def get_port_name(self) -> str:
         pass
 
 
@@ -118,21 +146,30 @@ class FtSwarmInput(FtSwarmIO):
         self._value = 0
         self._hysteresis = hysteresis
 
-    async def post_init(self) -> None:
-        await self._swarm.send(self._port_name, "setSensorType", await self.get_sensor_type(), self._normallyOpen)
-        await self._swarm.send(self._port_name, "subscribe", self._hysteresis)
-        self._value = await self._swarm.send(self._port_name, "getValue")
+    async def get_setup_queries(self) -> list[tuple[str | None, str, tuple]]:
+        return [
+            (None, "setSensorType", (await self.get_sensor_type(), self._normallyOpen)),
+            (None, "subscribe", (self._hysteresis,)),
+            ("", "getValue", ()),
+        ]
 
     async def get_sensor_type(self) -> Sensor:
         return Sensor.UNDEFINED
 
     async def on_trigger(self, trigger_event: Trigger, actor: FtSwarmActorShim, value: int | None = None) -> None:
         # The last parameter is optional, so we need to check if it is None
-        await self._swarm.send(self._port_name, "onTrigger", trigger_event, actor.get_port_name(), *([value] or []))
+        await self._swarm.send(self._port_name, "onTrigger", trigger_event, await actor.get_port_name(),
+                               *([] if value is None else [value]))
 
     async def set_value(self, str_value: str) -> None:
         self._value = int(str_value)
 
+    def get_cached_values(self) -> dict[str, int]:
+        return {"": self._value}
+
+    def store_cached_value(self, field: str, value: int) -> None:
+        self._value = value
+
 
 class FtSwarmDigitalInput(FtSwarmInput):
     """
@@ -295,8 +332,8 @@ class FtSwarmActor(FtSwarmIO):
         super().__init__(swarm, port_name)
         self._high_precision = high_precision
 
-    async def post_init(self) -> None:
-        await self._swarm.send(self._port_name, "setActorType", await self.get_actor_type(), self._high_precision)
+    async def get_setup_queries(self) -> list[tuple[str | None, str, tuple]]:
+        return [(None, "setActorType", (await self.get_actor_type(), self._high_precision))]
 
     async def get_actor_type(self) -> Actor:
         return Actor.UNDEFINDED
@@ -452,9 +489,8 @@ class FtSwarmServo(FtSwarmIO):
         self._position = 0
         self._offset = 0
 
-    async def post_init(self) -> None:
-        self._offset = self._swarm.send(self._port_name, "getOffset")
-        self._position = self._swarm.send(self._port_name, "getPositon")
+    async def get_setup_queries(self) -> list[tuple[str | None, str, tuple]]:
+        return [("offset", "getOffset", ()), ("position", "getPosition", ())]
 
     async def get_position(self) -> int:
         return self._position
@@ -470,6 +506,15 @@ class FtSwarmServo(FtSwarmIO):
         self._offset = offset
         await self._swarm.send(self._port_name, "setOffset", offset)
 
+    def get_cached_values(self) -> dict[str, int]:
+        return {"position": self._position, "offset": self._offset}
+
+    def get_refresh_queries(self) -> list[tuple[str, str, tuple]]:
+        return [("position", "getPosition", ()), ("offset", "getOffset", ())]
+
+    def store_cached_value(self, field: str, value: int) -> None:
+        setattr(self, "_" + field, value)
+
 
 class FtSwarmJoystick(FtSwarmIO):
     """
@@ -478,14 +523,14 @@ class FtSwarmJoystick(FtSwarmIO):
     ftSwarmControl only
     """
 
-    def __init__(self, swarm, port_name, hysteresis) -> None:
+    def __init__(self, swarm, port_name, hysteresis=0) -> None:
         super().__init__(swarm, port_name)
         self._lr = 0
         self._fb = 0
         self._hysteresis = hysteresis
 
-    async def post_init(self) -> None:
-        await self._swarm.send(self._port_name, "subscribe", self._hysteresis)
+    async def get_setup_queries(self) -> list[tuple[str | None, str, tuple]]:
+        return [(None, "subscribe", (self._hysteresis,))]
 
     async def get_fb(self) -> int:
         return self._fb
@@ -493,11 +538,22 @@ class FtSwarmJoystick(FtSwarmIO):
     async def get_lr(self) -> int:
         return self._lr
 
+    async def set_value(self, str_value: str) -> None:
+        # Subscription updates carry both axes: "<lr> <fb>"
+        lr, fb = str_value.replace(",", " ").split()
+        self._lr = int(lr)
+        self._fb = int(fb)
+
     async def on_trigger_lr(self, trigger_event, actor, p1=None) -> None:
-        await self._swarm.send(self._port_name, "onTriggerLR", trigger_event, actor, *(p1 or []))
+        await self._swarm.send(self._port_name, "onTriggerLR", trigger_event, await actor.get_port_name(),
+                               *([] if p1 is None else [p1]))
 
     async def on_trigger_fb(self, trigger_event, actor, p1=None) -> None:
-        await self._swarm.send(self._port_name, "onTriggerFB", trigger_event, actor, *(p1 or []))
+        await self._swarm.send(self._port_name, "onTriggerFB", trigger_event, await actor.get_port_name(),
+                               *([] if p1 is None else [p1]))
+
+    def get_cached_values(self) -> dict[str, int]:
+        return {"lr": self._lr, "fb": self._fb}
 
 
 class FtSwarmPixel(FtSwarmIO):
@@ -513,9 +569,8 @@ class FtSwarmPixel(FtSwarmIO):
         self._brightness = 0
         self._color = 0
 
-    async def post_init(self) -> None:
-        self._brightness = await self._swarm.send(self._port_name, "getBrightness")
-        self._color = await self._swarm.send(self._port_name, "getColor")
+    async def get_setup_queries(self) -> list[tuple[str | None, str, tuple]]:
+        return [("brightness", "getBrightness", ()), ("color", "getColor", ())]
 
     async def get_brightness(self) -> int:
         """
@@ -538,6 +593,15 @@ class FtSwarmPixel(FtSwarmIO):
         self._color = color
         await self._swarm.send(self._port_name, "setColor", color)
 
+    def get_cached_values(self) -> dict[str, int]:
+        return {"brightness": self._brightness, "color": self._color}
+
+    def get_refresh_queries(self) -> list[tuple[str, str, tuple]]:
+        return [("brightness", "getBrightness", ()), ("color", "getColor", ())]
+
+    def store_cached_value(self, field: str, value: int) -> None:
+        setattr(self, "_" + field, value)
+
 
 class FtSwarmI2C(FtSwarmIO):
     """
@@ -547,11 +611,10 @@ class FtSwarmI2C(FtSwarmIO):
     def __init__(self, swarm, port_name) -> None:
         super().__init__(swarm, port_name)
         self.__register = [0, 0, 0, 0, 0, 0, 0, 0]
+        self._last_register = None
 
-    async def post_init(self) -> None:
-        for i in range(8):
-            self.__register[i] = await self._swarm.send(self._port_name, "getRegister", i)
-        await self._swarm.send(self._port_name, "subscribe")
+    async def get_setup_queries(self) -> list[tuple[str | None, str, tuple]]:
+        return [(f"reg{i}", "getRegister", (i,)) for i in range(8)] + [(None, "subscribe", ())]
 
     async def get_register(self, reg) -> int:
         return self.__register[reg]
@@ -560,5 +623,27 @@ class FtSwarmI2C(FtSwarmIO):
         self.__register[reg] = value
         await self._swarm.send(self._port_name, "setRegister", reg, value)
 
-    async def on_trigger(self, trigger_event, actor, p1) -> None:
-        await self._swarm.send(self._port_name, "onTrigger", trigger_event, actor.get_port_name(), p1)
+    async def set_value(self, str_value: str) -> None:
+        # Subscription updates report a write by the I2C master: "<register> <value>"
+        reg, value = (int(part) for part in str_value.replace(",", " ").split())
+        if not 0 <= reg < len(self.__register):
+            raise ValueError(f"I2C register {reg} out of range")
+        self._last_register = reg
+        self.__register[reg] = value
+
+    async def get_last_written_value(self) -> int | None:
+        """
+        Value of the register the I2C master wrote last
+        :return: the value or None if nothing was written yet
+        """
+        return None if self._last_register is None else self.__register[self._last_register]
+
+    def get_cached_values(self) -> dict[str, int]:
+        return {f"reg{i}": value for i, value in enumerate(self.__register)}
+
+    def store_cached_value(self, field: str, value: int) -> None:
+        self.__register[int(field.removeprefix("reg"))] = value
+
+    async def on_trigger(self, trigger_event, actor, p1=None) -> None:
+        await self._swarm.send(self._port_name, "onTrigger", trigger_event, await actor.get_port_name(),
+                               *([] if p1 is None else [p1]))
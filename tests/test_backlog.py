@@ -0,0 +1,72 @@
+import asyncio
+
+from swarm import FtSwarm, FtSwarmSwitch
+from swarm.backlog import Backlog, OverflowPolicy
+
+
+def test_drop_oldest():
+    backlog = Backlog(2, OverflowPolicy.DROP_OLDEST)
+    assert backlog.put_nowait("S: A1 1")
+    assert backlog.put_nowait("S: A1 2")
+    assert not backlog.put_nowait("S: A2 3")
+    assert backlog.get_nowait() == "S: A1 2"
+    assert backlog.get_nowait() == "S: A2 3"
+    assert backlog.get_nowait() is None
+    assert backlog.dropped == 1
+    assert backlog.high_water == 2
+    assert backlog.size_bytes == 0
+
+
+def test_coalesce():
+    backlog = Backlog(2, OverflowPolicy.COALESCE)
+    backlog.put_nowait("S: A1 1")
+    backlog.put_nowait("S: A2 5")
+    backlog.put_nowait("S: A1 100")
+    assert len(backlog) == 2
+    assert backlog.coalesced == 1
+    assert backlog.dropped == 0
+    assert backlog.get_nowait() == "S: A1 100"
+    assert backlog.get_nowait() == "S: A2 5"
+
+
+def test_block():
+    async def run():
+        backlog = Backlog(1, OverflowPolicy.BLOCK)
+        await backlog.put("S: A1 1")
+        waiting = asyncio.create_task(backlog.put("S: A1 2"))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        assert backlog.get_nowait() == "S: A1 1"
+        assert await waiting
+        assert backlog.get_nowait() == "S: A1 2"
+        assert backlog.dropped == 0
+
+    asyncio.run(run())
+
+
+class BacklogHandler:
+    # Hands out a prefilled backlog like SerialHandler.get_message does while the serial port is quiet
+    def __init__(self, port, logger):
+        self.message_queue = Backlog(256, OverflowPolicy.BLOCK)
+
+    def try_reboot(self):
+        pass
+
+    async def get_message(self):
+        return self.message_queue.get_nowait()
+
+
+def test_input_loop_drains_backlog_without_sleeping():
+    async def run():
+        swarm = FtSwarm("fake", serial_handler_class=BacklogHandler)
+        switch = FtSwarmSwitch(swarm, "sw")
+        swarm.objects = {"sw": switch}
+        for i in range(100):
+            swarm.serial_handler.message_queue.put_nowait(f"S: sw {i}")
+
+        # The loop polls every 0.2 s while idle, 100 polls would take 20 s
+        await asyncio.sleep(0.1)
+        assert len(swarm.serial_handler.message_queue) == 0
+        assert switch._value == 99
+
+    asyncio.run(run())
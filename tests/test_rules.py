@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+
+from swarm.rules import RuleEngine, when
+from swarm.swarm import FtSwarmBase, FtSwarmI2C, FtSwarmJoystick, FtSwarmMotor, FtSwarmServo, FtSwarmSwitch, \
+    Trigger
+
+
+class RecordingSwarm(FtSwarmBase):
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+        self.rules = RuleEngine()
+
+    async def send(self, port_name, command, *args):
+        self.sent.append((port_name, command, *args))
+
+
+def test_compiles_to_on_trigger():
+    async def run():
+        swarm = RecordingSwarm()
+        switch = FtSwarmSwitch(swarm, "sw")
+        motor = FtSwarmMotor(swarm, "mot")
+
+        rule = await when(switch).up().then(motor).speed(200)
+        assert rule.compiled
+        assert swarm.sent == [("sw", "onTrigger", Trigger.TRIGGERUP, "mot", 200)]
+
+        # The firmware only has one slot per event, a second reaction must not race the first one
+        with pytest.raises(ValueError):
+            await when(switch).up().then(motor).off()
+        assert swarm.rules.host_rules == {}
+
+        await when(switch).changes().then(motor).follow()
+        assert swarm.sent[-1] == ("sw", "onTrigger", Trigger.TRIGGERVALUE, "mot")
+
+        # Only actors have a speed
+        for action in ("on", "off", "follow"):
+            with pytest.raises(TypeError):
+                getattr(when(switch).down().then(FtSwarmServo(swarm, "srv")), action)()
+
+    asyncio.run(run())
+
+
+def test_host_fallback():
+    async def run():
+        swarm = RecordingSwarm()
+        switch = FtSwarmSwitch(swarm, "sw")
+        servo = FtSwarmServo(swarm, "srv")
+        seen = []
+
+        await when(switch).down().then(servo).position(90)
+        await when(switch).above(0).call(seen.append)
+        assert swarm.sent == []
+
+        await switch.set_value("1")
+        await swarm.rules.dispatch(switch)
+        assert seen == [1]
+        assert swarm.sent == []
+
+        await switch.set_value("0")
+        await swarm.rules.dispatch(switch)
+        assert swarm.sent == [("srv", "setPosition", 90)]
+
+    asyncio.run(run())
+
+
+def test_host_rules_for_joystick_and_i2c():
+    async def run():
+        swarm = RecordingSwarm()
+        joystick = FtSwarmJoystick(swarm, "joy")
+        i2c = FtSwarmI2C(swarm, "i2c")
+        seen = []
+
+        await when(joystick, "lr").above(50).call(lambda value: seen.append(("lr", value)))
+        await when(i2c).written().call(lambda value: seen.append(("i2c", value)))
+        with pytest.raises(ValueError):
+            await when(i2c).read().call(print)
+        with pytest.raises(ValueError):
+            await when(i2c).up().call(print)
+
+        await joystick.set_value("80 -3")
+        await swarm.rules.dispatch(joystick)
+        await i2c.set_value("2 17")
+        await swarm.rules.dispatch(i2c)
+        assert seen == [("lr", 80), ("i2c", 17)]
+        assert await joystick.get_fb() == -3
+        assert await i2c.get_register(2) == 17
+
+    asyncio.run(run())
+
+
+def test_failing_rule_does_not_stop_dispatch():
+    async def run():
+        swarm = RecordingSwarm()
+        switch = FtSwarmSwitch(swarm, "sw")
+        seen = []
+
+        await when(switch).changes().call(lambda value: 1 / 0)
+        await when(switch).changes().call(seen.append)
+
+        for value in ("1", "0"):
+            await switch.set_value(value)
+            await swarm.rules.dispatch(switch)
+        assert seen == [1, 0]
+
+    asyncio.run(run())
+
+
+def test_i2c_update_checks_register():
+    async def run():
+        i2c = FtSwarmI2C(RecordingSwarm(), "i2c")
+        for update in ("9 1", "-1 1", "1"):
+            with pytest.raises(ValueError):
+                await i2c.set_value(update)
+        assert i2c._last_register is None
+
+    asyncio.run(run())
@@ -0,0 +1,276 @@
+import asyncio
+import logging
+import time
+
+import pytest
+import serial
+
+from swarm.backlog import OverflowPolicy
+from swarm.serialhandler import SerialHandler
+
+
+class FakeSerial:
+    # Answer every command like a ftSwarm would
+    auto_reply = False
+    instances = []
+
+    reply_delay = 0.0
+
+    def __init__(self, *args, **kwargs):
+        self.is_open = True
+        self.unplugged = False
+        self.written = []
+        self.incoming = bytearray()
+        self.delayed = []
+        FakeSerial.instances.append(self)
+
+    @property
+    def in_waiting(self):
+        if self.unplugged:
+            raise serial.SerialException("device disconnected")
+        while self.delayed and self.delayed[0][0] <= time.monotonic():
+            self.incoming += self.delayed.pop(0)[1]
+        return len(self.incoming)
+
+    def read(self, size):
+        data = bytes(self.incoming[:size])
+        del self.incoming[:size]
+        return data
+
+    def read_until(self, expected):
+        line, _, rest = bytes(self.incoming).partition(expected)
+        self.incoming = bytearray(rest)
+        return line + expected
+
+    def read_all(self):
+        return self.read(len(self.incoming))
+
+    def close(self):
+        self.is_open = False
+
+    def write(self, data):
+        if self.unplugged:
+            raise serial.SerialException("device disconnected")
+        self.written.append(data)
+        for line in data.decode("UTF-8").splitlines():
+            if line == "startCLI":
+                self.feed(b"@@@ ftSwarmOS CLI started\r\n")
+            elif self.auto_reply and "subscribe" not in line:
+                if self.reply_delay:
+                    self.delayed.append((time.monotonic() + self.reply_delay, b"R: 7\r\n"))
+                else:
+                    self.feed(b"R: 7\r\n")
+
+    def feed(self, data: bytes):
+        self.incoming += data
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    monkeypatch.setattr(serial, "Serial", FakeSerial)
+    monkeypatch.setattr(FakeSerial, "auto_reply", False)
+    monkeypatch.setattr(FakeSerial, "reply_delay", 0.0)
+    monkeypatch.setattr(FakeSerial, "instances", [])
+    return SerialHandler("fake", logging.getLogger("test"))
+
+
+def test_reply_and_backlog(handler):
+    async def run():
+        handler.ser.feed(b"S: A1 1\r\nR: 42\r\n")
+        assert await handler.send_and_wait("A1.getValue()") == "42"
+        assert await handler.get_message() == "S: A1 1"
+        assert handler.rtt.calls == 1
+        assert handler.rtt.srtt is not None
+
+    asyncio.run(run())
+
+
+def test_partial_lines_are_buffered(handler):
+    async def run():
+        handler.ser.feed(b"S: A1")
+        assert await handler.get_message() is None
+        handler.ser.feed(b" 1\r\n")
+        assert await handler.get_message() == "S: A1 1"
+
+    asyncio.run(run())
+
+
+def test_timeout_keeps_replies_in_sync(handler):
+    async def run():
+        with pytest.raises(TimeoutError):
+            await handler.send_and_wait("A1.getValue()", timeout=0.05)
+        assert handler.rtt.timeouts == 1
+        assert not handler.lock.locked()
+
+        # The late reply to the first command must not answer the second one
+        handler.ser.feed(b"R: 1\r\n")
+        FakeSerial.auto_reply = True
+        assert await handler.send_and_wait("A2.getValue()") == "7"
+
+    asyncio.run(run())
+
+
+def test_cancel_keeps_replies_in_sync(handler):
+    async def run():
+        task = asyncio.create_task(handler.send_and_wait("A1.getValue()", timeout=5))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert handler.rtt.cancelled == 1
+
+        handler.ser.feed(b"R: 1\r\n")
+        FakeSerial.auto_reply = True
+        assert await handler.send_and_wait("A2.getValue()") == "7"
+
+    asyncio.run(run())
+
+
+def test_reconnect_resubscribes_and_replays(handler):
+    async def run():
+        FakeSerial.auto_reply = True
+        resubscribed = []
+
+        async def on_reconnect(send_batch):
+            resubscribed.append(await send_batch(["A1.subscribe(0)", "A1.getValue()"], [False, True]))
+
+        handler.on_reconnect = on_reconnect
+        assert await handler.send_and_wait("A1.getValue()") == "7"
+
+        handler.ser.unplugged = True
+        with pytest.raises(serial.SerialException):
+            await handler.send_and_wait("A1.getValue()")
+        assert not handler.connected.is_set()
+        assert await handler.get_message() is None
+
+        # Held until the link is back, then sent on the new port after the setup burst
+        assert await handler.send_and_wait("M1.setSpeed(100)", timeout=1) == "7"
+        assert resubscribed == [[None, "7"]]
+        assert FakeSerial.instances[-1].written[1:] == [b"A1.subscribe(0)\r\nA1.getValue()\r\n",
+                                                       b"M1.setSpeed(100)\r\n"]
+        stats = handler.link_stats()
+        assert stats["disconnects"] == 1
+        assert stats["replayed"] == 1
+        assert stats["last_recovery_time"] is not None
+
+    asyncio.run(run())
+
+
+def test_full_hold_queue_fails_fast(handler):
+    async def run():
+        handler.max_held_commands = 0
+        handler.connected.clear()
+        with pytest.raises(serial.SerialException):
+            await handler.send_and_wait("A1.getValue()")
+        assert handler.rejected_commands == 1
+
+    asyncio.run(run())
+
+
+def test_lost_reply_resyncs(handler):
+    async def run():
+        handler.resync_interval = 0.05
+        with pytest.raises(TimeoutError):
+            await handler.send_and_wait("A1.getValue()", timeout=0.05)
+
+        # The reply to the first command never arrives, later commands must still get theirs
+        FakeSerial.auto_reply = True
+        for _ in range(3):
+            assert await handler.send_and_wait("A2.getValue()", timeout=1) == "7"
+        assert handler._abandoned_replies == 0
+
+    asyncio.run(run())
+
+
+def test_queueing_for_the_lock_is_no_timeout(handler):
+    async def run():
+        FakeSerial.auto_reply = True
+        FakeSerial.reply_delay = 0.03
+        handler.configure(min_reply_timeout=0.2)
+        for _ in range(5):
+            await handler.send_and_wait("A1.getValue()")
+        assert handler.rtt.timeout() < 0.5
+
+        # Each call alone is well within the default timeout, all of them together are not
+        replies = await asyncio.gather(*(handler.send_and_wait(f"A{i}.getValue()") for i in range(30)))
+        assert replies == ["7"] * 30
+        assert handler.rtt.timeouts == 0
+
+    asyncio.run(run())
+
+
+def test_reconnect_survives_a_failing_hook(handler):
+    async def run():
+        FakeSerial.auto_reply = True
+        handler.reconnect_delay = 0.01
+        calls = []
+
+        async def on_reconnect(send_batch):
+            calls.append(1)
+            if len(calls) == 1:
+                raise KeyError("broken setup")
+
+        handler.on_reconnect = on_reconnect
+        handler.ser.unplugged = True
+        with pytest.raises(serial.SerialException):
+            await handler.send_and_wait("A1.getValue()")
+
+        assert await handler.send_and_wait("A1.getValue()", timeout=1) == "7"
+        stats = handler.link_stats()
+        assert stats["reconnect_attempts"] == 2
+        assert "broken setup" in stats["last_reconnect_error"]
+
+    asyncio.run(run())
+
+
+def test_held_command_keeps_the_callers_deadline(handler):
+    async def run():
+        handler.connected.clear()
+        start = time.monotonic()
+        with pytest.raises(TimeoutError):
+            await handler.send_and_wait("A1.getValue()", timeout=0.1)
+        assert time.monotonic() - start < 1
+        assert handler.rejected_commands == 1
+
+        # Without a deadline of its own the command is held for hold_timeout
+        handler.hold_timeout = 0.05
+        with pytest.raises(serial.SerialException):
+            await handler.send_and_wait("A1.getValue()", timeout=1)
+
+    asyncio.run(run())
+
+
+def test_reply_timeout_keeps_its_floor(handler):
+    async def run():
+        FakeSerial.auto_reply = True
+        for _ in range(5):
+            await handler.send_and_wait("A1.getValue()")
+        assert handler.rtt.timeout() == 1.0
+
+    asyncio.run(run())
+
+
+def test_full_blocking_backlog_is_drained_without_the_lock(handler):
+    async def run():
+        handler.configure(backlog_size=2, overflow_policy=OverflowPolicy.BLOCK)
+        handler.ser.feed(b"".join(b"S: A1 %d\r\n" % i for i in range(5)) + b"R: 7\r\n")
+
+        # The sender holds the lock while it waits for room in the backlog
+        sender = asyncio.create_task(handler.send_and_wait("A1.getValue()", timeout=1))
+        await asyncio.sleep(0.05)
+        assert not sender.done()
+        assert len(handler.message_queue) == 2
+
+        async def drain():
+            messages = []
+            while not sender.done() or len(handler.message_queue):
+                message = await handler.get_message()
+                if message is not None:
+                    messages.append(message)
+            return messages
+
+        assert await asyncio.wait_for(drain(), 1) == [f"S: A1 {i}" for i in range(5)]
+        assert await sender == "7"
+        assert handler.message_queue.dropped == 0
+
+    asyncio.run(run())
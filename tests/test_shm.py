@@ -0,0 +1,56 @@
+import pytest
+
+from swarm.shm import HEADER, SEQ, SharedSnapshotReader, SharedSnapshotWriter
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "table")
+    writer = SharedSnapshotWriter(path, capacity=2)
+    writer.register("ftswarm1.A1")
+    reader = SharedSnapshotReader(path)
+
+    assert reader.read("ftswarm1.A1") == (0, 0.0)
+    assert writer.publish("ftswarm1.A1", 512, 1.5)
+    assert not writer.publish("unknown", 1)
+    assert reader.read("ftswarm1.A1") == (512, 1.5)
+
+    # Ports registered after attaching are picked up on demand
+    writer.register("switch")
+    writer.publish("switch", 1)
+    assert reader["switch"] == 1
+    assert reader.ports() == ["ftswarm1.A1", "switch"]
+
+    reader.close()
+    writer.close()
+
+
+def test_recreating_keeps_old_readers_alive(tmp_path):
+    path = str(tmp_path / "table")
+    writer = SharedSnapshotWriter(path)
+    writer.register("A1")
+    writer.publish("A1", 5, 1.0)
+    old_reader = SharedSnapshotReader(path)
+
+    # A new owner replaces the file instead of truncating the mapped one
+    new_writer = SharedSnapshotWriter(path)
+    assert old_reader.read("A1") == (5, 1.0)
+    assert SharedSnapshotReader(path).ports() == []
+
+    old_reader.close()
+    writer.close()
+    new_writer.close()
+
+
+def test_stuck_write_raises(tmp_path):
+    path = str(tmp_path / "table")
+    writer = SharedSnapshotWriter(path)
+    writer.register("A1")
+    # Simulate a writer that died between the two sequence updates
+    SEQ.pack_into(writer._mmap, HEADER.size, 1)
+    reader = SharedSnapshotReader(path)
+
+    with pytest.raises(RuntimeError):
+        reader.read("A1")
+
+    reader.close()
+    writer.close()
@@ -0,0 +1,94 @@
+import asyncio
+
+from swarm import FtSwarm, FtSwarmI2C, FtSwarmJoystick, FtSwarmPixel, FtSwarmSwitch, SharedSnapshotReader
+
+
+class FakeHandler:
+    def __init__(self, port, logger):
+        self.batches = []
+
+    def try_reboot(self):
+        pass
+
+    def close(self):
+        pass
+
+    async def send_and_wait(self, cmd, wait_for_return=True, timeout=None):
+        return None
+
+    async def send_batch(self, cmds, timeout=None):
+        self.batches.append(cmds)
+        return [str(i) for i in range(len(cmds))]
+
+    async def get_message(self):
+        return None
+
+
+def test_snapshot():
+    async def run():
+        swarm = FtSwarm("fake", serial_handler_class=FakeHandler)
+        switch = FtSwarmSwitch(swarm, "sw")
+        await switch.set_value("1")
+        joystick = FtSwarmJoystick(swarm, "joy")
+        await joystick.set_value("-50 0")
+        swarm.objects = {"sw": switch, "joy": joystick, "px": FtSwarmPixel(swarm, "px")}
+
+        snapshot = await swarm.snapshot()
+        assert snapshot.as_dict() == {"sw": 1, "joy.lr": -50, "joy.fb": 0, "px.brightness": 0, "px.color": 0}
+        assert snapshot["joy.lr"] == -50
+        assert len(snapshot.to_bytes()) == 5 * 8
+        assert swarm.serial_handler.batches == []
+
+        # Subscribed ports are current without a refresh
+        swarm.objects["i2c"] = FtSwarmI2C(swarm, "i2c")
+        await swarm.objects["i2c"].set_value("7 11")
+        await joystick.set_value("-50 20")
+        snapshot = await swarm.snapshot()
+        assert snapshot["joy.fb"] == 20
+        assert snapshot["i2c.reg7"] == 11
+
+        snapshot = await swarm.snapshot(refresh=True)
+        assert swarm.serial_handler.batches == [["px.getBrightness()", "px.getColor()"]]
+        assert snapshot["px.color"] == 1
+        assert snapshot["sw"] == 1
+
+    asyncio.run(run())
+
+
+def test_shared_table_mirrors_subscribed_ports(tmp_path):
+    async def run():
+        path = str(tmp_path / "table")
+        swarm = FtSwarm("fake", serial_handler_class=FakeHandler, shared_table=path)
+        joystick = await swarm.get_joystick("joy")
+        await swarm.get_i2c("i2c")
+        reader = SharedSnapshotReader(path)
+        assert reader.ports() == ["joy.lr", "joy.fb"] + [f"i2c.reg{i}" for i in range(8)]
+
+        await joystick.set_value("12 -34")
+        swarm._publish(joystick)
+        assert reader["joy.lr"] == 12
+        assert reader["joy.fb"] == -34
+
+        # Only changed fields get a new timestamp, an I2C write always does
+        _, fb_time = reader.read("joy.fb")
+        await joystick.set_value("13 -34")
+        swarm._publish(joystick)
+        assert reader["joy.lr"] == 13
+        assert reader.read("joy.fb")[1] == fb_time
+
+        async def get_message():
+            return "S: i2c 3 0"
+
+        swarm.serial_handler.get_message = get_message
+        _, reg3_time = reader.read("i2c.reg3")
+        assert await swarm.queue_use()
+        assert reader.read("i2c.reg3")[1] > reg3_time
+        assert reader.read("i2c.reg4")[1] == reg3_time
+
+        reader.close()
+        swarm.close()
+        await asyncio.sleep(0)
+        assert swarm._input_task.cancelled()
+
+    asyncio.run(run())
+